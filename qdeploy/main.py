@@ -4,21 +4,30 @@ generate files to deploy libvirt vms and nws, possibly in a docker environment
 """
 from __future__ import print_function
 
+import base64
+import errno
+import hashlib
+import ipaddress
+import json
 import logging
 import os
+import re
 import shutil
 import sys
 import shlex
+import socket
+import time
 import argparse
 from copy import deepcopy
 from enum import Enum
+from multiprocessing.pool import ThreadPool
 from lxml import etree
 
 import argh
 from argh.decorators import arg, named
 from argh.exceptions import CommandError
 from etconfig import ElementConfError, load, id2elt
-from qdeploy.utils import cmd, resource_path
+from qdeploy.utils import CmdResult, cmd, file_lock, resource_path
 
 try:  # py3
     from shlex import quote as sh_quote
@@ -39,6 +48,32 @@ QDEPLOY_RESOURCES_DIR = ".qdeploy"
 QDEPLOY_CONF = "./qdeploy.conf"
 QDEPLOY_DEFAULT_CONTAINER_NAME = "qdeploy"
 
+# persistent mode: description of the vms, used to detect that a vm
+# defined in the container must be reinstalled
+QDEPLOY_VM_FINGERPRINT = "qdeploy-fingerprint:{}"
+
+# graceful stop: default deadline and poll interval (seconds)
+QDEPLOY_SHUTDOWN_TIMEOUT = 60
+QDEPLOY_SHUTDOWN_POLL_INTERVAL = 2
+
+# vm-exec: default number of concurrent vms, deadline and poll
+# interval (seconds)
+QDEPLOY_EXEC_JOBS = 8
+QDEPLOY_EXEC_TIMEOUT = 60
+QDEPLOY_EXEC_POLL_INTERVAL = 1
+
+# lab namespace: environment variable overriding the 'lab' element,
+# environment variable giving the pid of the process owning the lab,
+# directory (in the container) where the running labs are registered
+# and host lock serializing the labs sharing a container
+QDEPLOY_LAB_ENV = "QDEPLOY_LAB"
+QDEPLOY_LAB_PID_ENV = "QDEPLOY_LAB_PID"
+QDEPLOY_LAB_DIR = "/var/lib/qdeploy/labs"
+QDEPLOY_LAB_LOCK = "/tmp/qdeploy-{container}.lock"
+
+# max length of a bridge (network interface) name, IFNAMSIZ - 1
+MAX_BRIDGE_NAME_LEN = 15
+
 
 def vm_extend(vm, vm_defaults):
     """add to vm the parameters from vm_defaults that are not defined in
@@ -63,6 +98,73 @@ def get_vm_group(group_name):
     res_elem_list = [e.text for e in elems]
     return res_elem_list
 
+def get_lab_name():
+    """get the lab namespace from the QDEPLOY_LAB environment variable
+    or from the 'lab' element of the conf, None if not defined
+    """
+    root = conf
+    lab = os.environ.get(QDEPLOY_LAB_ENV)
+    if not lab:
+        lab_node = root.find("lab")
+        if lab_node is None:
+            return None
+        lab = lab_node.text
+
+    if not lab or not re.match(r"^[A-Za-z0-9_.]+$", lab):
+        raise CommandError("Invalid lab name '{}'".format(lab))
+    return lab
+
+def lab_name(name):
+    """prefix a domain or network name with the lab namespace (if any)
+
+    :param name: name of the vm or network in qdeploy.conf
+    """
+    lab = get_lab_name()
+    if lab is None:
+        return name
+    return "{}-{}".format(lab, name)
+
+def lab_bridge_name(name):
+    """prefix a bridge name with the lab namespace (if any). Bridge
+    names are limited to 15 characters, so a hash is used when the
+    prefixed name is too long.
+
+    :param name: name of the bridge in qdeploy.conf
+    """
+    res = lab_name(name)
+    if len(res) > MAX_BRIDGE_NAME_LEN:
+        digest = hashlib.sha1(res.encode("utf-8")).hexdigest()
+        res = "qd" + digest[:MAX_BRIDGE_NAME_LEN - 2]
+    return res
+
+def lab_network(nw):
+    """get a copy of a network with names in the lab namespace
+
+    :param nw: Element representing the network in libvirt format
+    """
+    if get_lab_name() is None:
+        return nw
+    nw = deepcopy(nw)
+    name_node = nw.find('name')
+    name_node.text = lab_name(name_node.text)
+    bridge_node = nw.find('bridge')
+    if bridge_node is not None and bridge_node.get('name'):
+        bridge_node.set('name', lab_bridge_name(bridge_node.get('name')))
+    return nw
+
+def lab_network_option(val):
+    """rewrite the network name of a virt-install --network option
+    (e.g. 'network=nw2,model=e1000') in the lab namespace
+
+    :param val: value of the --network option
+    """
+    opts = []
+    for opt in val.split(","):
+        if opt.startswith("network="):
+            opt = "network=" + lab_name(opt[len("network="):])
+        opts.append(opt)
+    return ",".join(opts)
+
 def find_elem_list(tag, name_list, _all=False):
     """find a list of Element with:
 
@@ -121,11 +223,12 @@ def is_running_in_docker():
     docker = root.find("docker")
     return docker is not None
 
-def run_in_container(a_cmd, _interactive=False, _detached=False):
+def run_in_container(a_cmd, _interactive=False, _detached=False, _quiet=False):
     """execute a system command possibly inside the docker container
 
     :param a_cmd:
     :param _interactive:  (Default value = False)
+    :param _quiet: do not print errors if True (Default value = False)
 
     """
     if is_running_in_docker():
@@ -145,7 +248,8 @@ def run_in_container(a_cmd, _interactive=False, _detached=False):
     if _detached:
         res.wait()
 
-    res.print_on_error()
+    if not _quiet:
+        res.print_on_error()
     return res
 
 
@@ -188,6 +292,11 @@ def generate_virt_install_cmd(vm, vm_defaults, extra_args=None):
         else:
             val = arg_i.text
 
+        if val and arg_i.tag == "name":
+            val = lab_name(val)
+        elif val and arg_i.tag == "network":
+            val = lab_network_option(val)
+
         if val:
             cmd_array.append(sh_quote(val))
 
@@ -210,6 +319,16 @@ def get_container_name():
 
     return name_node.text
 
+def is_persistent_container():
+    """check if the docker container must be kept when stopped
+    ('persistent true;' in the docker section)
+    """
+    root = conf
+    persistent_node = root.find("docker/persistent")
+    if persistent_node is None:
+        return False
+    return persistent_node.text in (None, "true")
+
 def do_start_docker():
     """start docker container by calling the .qdeploy/start_docker.sh
     script
@@ -231,7 +350,10 @@ def do_start_docker():
     if x11_node is not None:
         use_x11 = x11_node.text
 
-    res = cmd(["./start_docker.sh", container_name, use_x11, mounts],
+    persistent = "true" if is_persistent_container() else "false"
+
+    res = cmd(["./start_docker.sh", container_name, use_x11, mounts,
+               persistent],
               _log=logger, _cwd=QDEPLOY_RESOURCES_DIR)
     res.exit_on_error()
 
@@ -244,18 +366,338 @@ def do_stop_docker():
     if not container_name:
         raise CommandError("No docker container name defined in qdeploy.conf")
 
-    res = cmd("./stop_docker.sh {container}", container=container_name, _log=logger)
+    persistent = "true" if is_persistent_container() else "false"
+
+    res = cmd("./stop_docker.sh {container} {persistent}",
+              container=container_name, persistent=persistent, _log=logger)
     res.print_on_error()
     print(res.out)
 
 
 
+def is_container_running():
+    """check if the docker container is running
+    """
+    container_name = get_container_name()
+    if not container_name:
+        raise CommandError("No docker container name defined in qdeploy.conf")
+
+    res = cmd(["docker", "inspect", "--format", "{{ .State.Running }}",
+               container_name], _log=logger)
+    return res.success and res.out.strip() == "true"
+
+def get_lab_lock():
+    """get the path of the host lock file serializing the labs sharing
+    the docker container
+    """
+    return QDEPLOY_LAB_LOCK.format(container=get_container_name())
+
+def get_labs():
+    """get the labs registered in the docker container
+
+    :returns: a dictionary lab name -> owner information (host, user,
+    cwd, started and optionally pid)
+    """
+    res = run_in_container(
+        ["sh", "-c", 'cd "$1" 2>/dev/null || exit 0; '
+         'for f in *; do [ -f "$f" ] && echo "$f $(cat "$f")"; done; exit 0',
+         "sh", QDEPLOY_LAB_DIR], _quiet=True)
+    labs = {}
+    if not res.success:
+        return labs
+    for line in res:
+        fields = line.strip().split(" ", 1)
+        if not fields[0]:
+            continue
+        try:
+            labs[fields[0]] = json.loads(fields[1])
+        except (IndexError, ValueError):
+            labs[fields[0]] = {}
+    return labs
+
+def is_lab_stale(owner):
+    """check if the process owning a lab is gone. Only possible if the
+    lab was started on this host with QDEPLOY_LAB_PID set.
+
+    :param owner: owner information of the lab (see get_labs)
+    """
+    if "pid" not in owner or owner.get("host") != socket.gethostname():
+        return False
+    try:
+        os.kill(owner["pid"], 0)
+    except OSError as exc:
+        return exc.errno == errno.ESRCH
+    return False
+
+def get_running_labs():
+    """get the names of the labs registered in the docker container,
+    after pruning the stale ones
+    """
+    labs = get_labs()
+    for lab, owner in sorted(labs.items()):
+        if is_lab_stale(owner):
+            logger.warning("owner of lab %s (pid %s) is gone, pruning it",
+                           lab, owner["pid"])
+            do_prune_lab(lab)
+    return sorted(lab for lab in labs if not is_lab_stale(labs[lab]))
+
+def do_register_lab(lab, clear=False):
+    """register a lab in the docker container
+
+    :param lab: name of the lab
+    :param clear: forget the labs registered before if True, e.g. when
+    the container has just been (re)started (Default value = False)
+
+    """
+    owner = {"host": socket.gethostname(),
+             "user": os.environ.get("USER", ""),
+             "cwd": os.getcwd(),
+             "started": time.strftime("%Y-%m-%d %H:%M:%S")}
+    pid = get_lab_pid()
+    if pid is not None:
+        owner["pid"] = pid
+
+    if clear:
+        run_in_container(["rm", "-rf", QDEPLOY_LAB_DIR])
+    run_in_container(["mkdir", "-p", QDEPLOY_LAB_DIR])
+    run_in_container(["sh", "-c", 'echo "$1" > "$2"', "sh",
+                      json.dumps(owner),
+                      os.path.join(QDEPLOY_LAB_DIR, lab)])
+
+def do_unregister_lab(lab):
+    """unregister a lab from the docker container
+
+    :param lab: name of the lab
+    """
+    run_in_container(["rm", "-f", os.path.join(QDEPLOY_LAB_DIR, lab)])
+
+def get_lab_resources(lab):
+    """get the names of the domains and networks of a lab, without its
+    conf, from the lab prefix
+
+    :param lab: name of the lab
+
+    :returns: a tuple (domain names, network names)
+    """
+    # '-' is not allowed in lab names, so '<lab>-' is unambiguous
+    prefix = lab + "-"
+
+    res = []
+    for list_cmd in (["virsh", "list", "--all", "--name"],
+                     ["virsh", "net-list", "--all", "--name"]):
+        out = run_in_container(list_cmd, _quiet=True)
+        names = [l.strip() for l in out] if out.success else []
+        res.append([n for n in names if n.startswith(prefix)])
+    return tuple(res)
+
+def do_prune_lab(lab):
+    """destroy and undefine all the vms and networks of a lab from
+    its prefix, and unregister it. Used for labs whose owner is gone.
+
+    :param lab: name of the lab
+    """
+    vm_names, nw_names = get_lab_resources(lab)
+    run_virsh_batch(["destroy " + sh_quote(n) for n in vm_names] +
+                    ["undefine " + sh_quote(n) for n in vm_names])
+    run_virsh_batch(["net-destroy " + sh_quote(n) for n in nw_names] +
+                    ["net-undefine " + sh_quote(n) for n in nw_names])
+    do_unregister_lab(lab)
+
+def get_network_subnets(nw):
+    """get the ip subnets of a network
+
+    :param nw: Element representing the network in libvirt format
+    :returns: a list of ipaddress networks
+    """
+    subnets = []
+    for ip in nw.iterfind("ip"):
+        address = ip.get("address")
+        if not address:
+            continue
+        mask = ip.get("prefix") or ip.get("netmask")
+        if mask:
+            address = u"{}/{}".format(address, mask)
+        subnets.append(ipaddress.ip_interface(u"{}".format(address)).network)
+    return subnets
+
+def check_lab_networks(nw_list):
+    """fail if the subnet of a network of the lab overlaps with a
+    network already active in the container (e.g. owned by another lab)
+
+    :param nw_list: list of Element representing the networks to start
+    """
+    root = conf
+    own_names = set(lab_name(n.text) for n in root.iterfind("network/name"))
+
+    res = run_in_container(["virsh", "net-list", "--name"], _quiet=True)
+    active = [l.strip() for l in res] if res.success else []
+    active_subnets = []
+    for name in active:
+        if not name or name in own_names:
+            continue
+        xml = run_in_container(["virsh", "net-dumpxml", name], _quiet=True)
+        if xml.success:
+            for subnet in get_network_subnets(etree.fromstring(xml.out)):
+                active_subnets.append((name, subnet))
+
+    for nw in nw_list:
+        for subnet in get_network_subnets(nw):
+            for other_name, other_subnet in active_subnets:
+                if subnet.version == other_subnet.version and \
+                   subnet.overlaps(other_subnet):
+                    raise CommandError(
+                        "network '{}' ({}) overlaps with network '{}' ({}) "
+                        "already active in the container: labs sharing a "
+                        "container need disjoint subnets".format(
+                            nw.find('name').text, subnet,
+                            other_name, other_subnet))
+
+def get_vm_disks(vm):
+    """get the disk paths of a vm, as given to virt-install
+
+    :param vm: Element representing the vm
+    :returns: a list of absolute paths
+    """
+    root = conf
+    disks = vm.findall("disk")
+    vm_defaults = root.find("vm_defaults")
+    if not disks and vm_defaults is not None:
+        disks = vm_defaults.findall("disk")
+    if not disks:
+        # default disk, see generate_virt_install_cmd
+        return [os.path.join(os.getcwd(), vm.find('name').text + ".qcow2")]
+
+    paths = []
+    for disk in disks:
+        if disk.attrib:
+            path = disk.get("path")
+        else:
+            opts = (disk.text or "").split(",")
+            path = None
+            for opt in opts:
+                if opt.startswith("path="):
+                    path = opt[len("path="):]
+            if path is None and "=" not in opts[0]:
+                path = opts[0]
+        if path:
+            paths.append(os.path.abspath(path))
+    return paths
+
+def check_lab_disks(vm_list):
+    """fail if a disk of a vm of the lab is used by a domain of the
+    container which does not belong to the lab (e.g. another lab
+    started from the same directory)
+
+    :param vm_list: list of Element representing the vms to start
+    """
+    root = conf
+    own_names = set(lab_name(n.text) for n in root.iterfind("vm/name"))
+
+    res = run_in_container(["virsh", "list", "--all", "--name"], _quiet=True)
+    domains = [l.strip() for l in res] if res.success else []
+    used_disks = {}
+    for name in domains:
+        if not name or name in own_names:
+            continue
+        blk = run_in_container(["virsh", "domblklist", name], _quiet=True)
+        if not blk.success:
+            continue
+        # skip the 'Target Source' header up to the dashed line
+        in_header = True
+        for line in blk:
+            if in_header:
+                in_header = not line.strip().startswith("---")
+                continue
+            fields = line.split(None, 1)
+            if len(fields) == 2 and fields[1].strip() != "-":
+                used_disks[fields[1].strip()] = name
+
+    for vm in vm_list:
+        for path in get_vm_disks(vm):
+            if path in used_disks:
+                raise CommandError(
+                    "disk {} of vm '{}' is already used by domain '{}' in "
+                    "the container: labs sharing a container need "
+                    "distinct disks".format(path, vm.find('name').text,
+                                            used_disks[path]))
+
+def get_lab_pid():
+    """get the pid of the process owning the lab (QDEPLOY_LAB_PID), or
+    None if not defined
+    """
+    pid = os.environ.get(QDEPLOY_LAB_PID_ENV)
+    if not pid:
+        return None
+    try:
+        return int(pid)
+    except ValueError:
+        raise CommandError("Invalid {} '{}'".format(QDEPLOY_LAB_PID_ENV, pid))
+
+def check_lab_owner(lab, labs):
+    """fail if the lab is already registered by another owner, or if
+    another lab of this host runs from the current directory (the
+    .qdeploy directory and the default disks would be shared). Stale
+    labs are ignored.
+
+    :param lab: name of the lab
+    :param labs: registered labs (see get_labs)
+    """
+    host = socket.gethostname()
+    cwd = os.getcwd()
+    for other, owner in sorted(labs.items()):
+        if is_lab_stale(owner):
+            continue
+        if other == lab:
+            same_owner = (owner.get("host") == host and
+                          owner.get("cwd") == cwd and
+                          owner.get("pid") in (None, get_lab_pid()))
+            if not same_owner:
+                raise CommandError(
+                    "lab '{}' is already registered by {}@{} in {}".format(
+                        lab, owner.get("user"), owner.get("host"),
+                        owner.get("cwd")))
+        elif owner.get("host") == host and owner.get("cwd") == cwd:
+            raise CommandError(
+                "lab '{}' already runs from {}: labs sharing a container "
+                "need distinct working directories".format(other, cwd))
+
+def do_stop_lab():
+    """destroy and undefine all the vms and networks of the lab, so
+    that the container can be left to the other labs
+    """
+    root = conf
+    vm_names = [lab_name(n.text) for n in root.iterfind("vm/name")]
+    nw_names = [lab_name(n.text) for n in root.iterfind("network/name")]
+
+    run_virsh_batch(["destroy " + sh_quote(n) for n in vm_names] +
+                    ["undefine " + sh_quote(n) for n in vm_names])
+    run_virsh_batch(["net-destroy " + sh_quote(n) for n in nw_names] +
+                    ["net-undefine " + sh_quote(n) for n in nw_names])
+
+def do_start_container():
+    """start docker container and execute the docker start commands
+    """
+    root = conf
+    do_start_docker()
+    for c in root.iterfind("docker/start_cmd"):
+        run_in_container(c.text)
+
+def do_stop_container():
+    """stop docker container and execute the docker stop commands
+    """
+    root = conf
+    do_stop_docker()
+    for c in root.iterfind("docker/stop_cmd"):
+        run_in_container(c.text)
+
+
 def do_start_nw(nw):
     """define and start a network
 
     :param nw: Element representing the network in libvirt format
 
     """
+    nw = lab_network(nw)
     xml_file_name = generate_network_xml_file(QDEPLOY_RESOURCES_DIR, nw)
     name = nw.find('name').text
 
@@ -272,7 +714,7 @@ def do_stop_nw(nw):
 
     """
     # xml_file_name = generate_network_xml_file(QDEPLOY_RESOURCES_DIR, nw)
-    name = nw.find('name').text
+    name = lab_name(nw.find('name').text)
 
     # abs_path = os.path.join(os.getcwd(), xml_file_name)
     # assume xml_file_name mounted in docker at the same location
@@ -287,8 +729,24 @@ def do_start_vm(vm, extra_args=None):
 
     """
     root = conf
+    name = lab_name(vm.find('name').text)
     vm_defaults = root.find("vm_defaults")
     virtinst_cmd = generate_virt_install_cmd(vm, vm_defaults, extra_args)
+
+    if not extra_args and is_running_in_docker() and is_persistent_container():
+        # the domain may survive from a previous run of the container:
+        # reuse it only if it was installed with the same command
+        fingerprint = QDEPLOY_VM_FINGERPRINT.format(hashlib.sha1(
+            " ".join(virtinst_cmd).encode("utf-8")).hexdigest())
+        res = run_in_container(["virsh", "desc", name], _quiet=True)
+        if res.success:
+            if res.out.strip() == fingerprint:
+                return run_in_container(["virsh", "start", name])
+            logger.info("definition of vm %s changed, reinstalling", name)
+            run_in_container(["virsh", "destroy", name], _quiet=True)
+            run_in_container(["virsh", "undefine", name])
+        virtinst_cmd += ["--metadata", "description=" + fingerprint]
+
     res = run_in_container(virtinst_cmd)
     return res
 
@@ -300,6 +758,7 @@ class StopMode(Enum):
     DESTROY = 1
     SHUTDOWN = 2
     REBOOT = 3
+    GRACEFUL = 4
 
 def do_stop_vm(vm, stop_mode=StopMode.DESTROY):
     """undefine and stop a vm
@@ -309,7 +768,7 @@ def do_stop_vm(vm, stop_mode=StopMode.DESTROY):
 
     """
     # root = conf
-    name = vm.find('name').text
+    name = lab_name(vm.find('name').text)
 
     if stop_mode == StopMode.DESTROY:
         run_in_container(["virsh", "destroy", name])
@@ -323,6 +782,123 @@ def do_stop_vm(vm, stop_mode=StopMode.DESTROY):
         print("internal error invalid stop mode")
 
 
+def run_virsh_batch(virsh_cmds):
+    """execute several virsh commands with a single virsh invocation
+
+    :param virsh_cmds: list of virsh commands (e.g. 'undefine vm1')
+
+    """
+    if not virsh_cmds:
+        return None
+    return run_in_container(["virsh", " ; ".join(virsh_cmds)])
+
+
+def get_active_domains():
+    """get the names of the running domains
+
+    :returns: a set of domain names or None if virsh failed
+    """
+    res = run_in_container(["virsh", "list", "--name"], _quiet=True)
+    if not res.success:
+        return None
+    return set(line.strip() for line in res if line.strip())
+
+
+def do_stop_vm_list_graceful(vm_list, timeout=QDEPLOY_SHUTDOWN_TIMEOUT):
+    """shutdown several vms at once, destroy the ones still running
+    after the deadline, then undefine them all
+
+    :param vm_list: list of Element representing the vms
+    :param timeout: seconds to wait for the vms to shutdown
+
+    """
+    names = [lab_name(vm.find('name').text) for vm in vm_list]
+    deadline = time.time() + timeout
+
+    active = get_active_domains()
+    pending = set(names) if active is None else active & set(names)
+    run_virsh_batch(["shutdown " + sh_quote(n) for n in sorted(pending)])
+
+    while pending and time.time() < deadline:
+        time.sleep(QDEPLOY_SHUTDOWN_POLL_INTERVAL)
+        active = get_active_domains()
+        if active is not None:
+            pending &= active
+
+    if pending:
+        logger.warning("vms still running after %ss, destroying: %s",
+                       timeout, " ".join(sorted(pending)))
+        run_virsh_batch(["destroy " + sh_quote(n) for n in sorted(pending)])
+
+    run_virsh_batch(["undefine " + sh_quote(n) for n in names])
+
+
+def guest_agent_command(name, execute, arguments):
+    """send a command to the qemu-guest-agent of a vm
+
+    :param name: name of the vm
+    :param execute: agent command (e.g. 'guest-exec')
+    :param arguments: dictionary with the agent command arguments
+
+    :returns: a tuple (answer, error) where answer is the 'return'
+    member of the agent reply, or None on error
+    """
+    request = json.dumps({"execute": execute, "arguments": arguments})
+    res = run_in_container(["virsh", "qemu-agent-command", name, request],
+                           _quiet=True)
+    if not res.success:
+        return None, (res.err or res.out or "").strip()
+    try:
+        return json.loads(res.out)["return"], None
+    except (ValueError, KeyError):
+        return None, "invalid agent reply: {}".format(res.out)
+
+
+def do_exec_vm(vm, command, timeout=QDEPLOY_EXEC_TIMEOUT):
+    """execute a shell command in a vm through the qemu-guest-agent
+
+    :param vm: Element representing the vm
+    :param command: shell command to execute in the vm
+    :param timeout: seconds to wait for the command to finish
+
+    :returns: instance of CmdResult (returncode -1 if the command
+    could not be executed or did not finish in time)
+    """
+    name = lab_name(vm.find('name').text)
+    answer, error = guest_agent_command(
+        name, "guest-exec", {"path": "/bin/sh", "arg": ["-c", command],
+                             "capture-output": True})
+    if answer is None:
+        return CmdResult(None, -1, err=error)
+
+    pid = answer["pid"]
+    deadline = time.time() + timeout
+    while True:
+        status, error = guest_agent_command(name, "guest-exec-status",
+                                            {"pid": pid})
+        if status is None:
+            return CmdResult(None, -1, err=error)
+        if status.get("exited"):
+            break
+        if time.time() >= deadline:
+            # best effort: do not leave the command running in the vm
+            guest_agent_command(
+                name, "guest-exec",
+                {"path": "/bin/sh",
+                 "arg": ["-c", "pkill -KILL -P {0}; kill -KILL {0}".format(pid)]})
+            return CmdResult(None, -1, err="timeout after {}s, killed".format(
+                timeout))
+        time.sleep(QDEPLOY_EXEC_POLL_INTERVAL)
+
+    if "exitcode" in status:
+        returncode = status["exitcode"]
+    else:
+        returncode = 128 + status.get("signal", 0)
+    out = base64.b64decode(status.get("out-data", ""))
+    err = base64.b64decode(status.get("err-data", ""))
+    return CmdResult(None, returncode, out, err)
+
+
 def assert_conf():
     """
     check if config file has been loaded successfully or exit on error
@@ -371,6 +947,11 @@ def cmd_start():
     start docker environment, then all networks and all vms
     """
     assert_conf()
+    lab = get_lab_name()
+    if lab is not None and is_running_in_docker() and is_container_running():
+        # before cmd_init overwrites the .qdeploy directory. Read only:
+        # cmd_start_env checks again, and prunes, under the lab lock
+        check_lab_owner(lab, get_labs())
     cmd_init(force=True)
     cmd_start_env()
     cmd_start_nw(net_names=None, start_all=True)
@@ -396,16 +977,27 @@ def cmd_start_env():
     root = conf
 
     if is_running_in_docker():
-        do_start_docker()
-        for c in root.iterfind("docker/start_cmd"):
-            run_in_container(c.text)
-
+        lab = get_lab_name()
+        if lab is None:
+            do_start_container()
+        else:
+            with file_lock(get_lab_lock()):
+                started = not is_container_running()
+                if started:
+                    do_start_container()
+                else:
+                    print("=> Attaching lab {} to running container {}".
+                          format(lab, get_container_name()))
+                    get_running_labs()
+                    check_lab_owner(lab, get_labs())
+                do_register_lab(lab, clear=started)
 
     for c in root.iterfind("start_cmd"):
         cmd(c.text, _log=logger)
 
 @named("env-stop")
-def cmd_stop_env():
+@arg("-f", "--force", help="stop the container even if other labs use it")
+def cmd_stop_env(force=False):
     """
     stop docker container
     """
@@ -413,14 +1005,58 @@ def cmd_stop_env():
     root = conf
 
     if is_running_in_docker():
-        do_stop_docker()
-        for c in root.iterfind("docker/stop_cmd"):
-            run_in_container(c.text)
+        lab = get_lab_name()
+        if lab is None:
+            do_stop_container()
+        else:
+            with file_lock(get_lab_lock()):
+                do_stop_lab()
+                do_unregister_lab(lab)
+                labs = get_running_labs()
+                if labs and not force:
+                    print("=> Leaving container {} to labs {}".format(
+                        get_container_name(), " ".join(labs)))
+                else:
+                    do_stop_container()
 
     for c in root.iterfind("stop_cmd"):
         cmd(c.text, _log=logger)
 
 
+@named("lab-list")
+def cmd_list_lab():
+    """display the labs registered in the docker container
+    """
+    assert_conf()
+    if not is_running_in_docker():
+        raise CommandError("Labs are only available in docker")
+
+    for lab, owner in sorted(get_labs().items()):
+        info = " ".join("{}={}".format(k, v) for k, v in sorted(owner.items()))
+        state = " (stale)" if is_lab_stale(owner) else ""
+        print("{}{}: {}".format(lab, state, info))
+
+@named("lab-prune")
+@arg("lab_names", nargs='*', help="names of the labs to remove")
+def cmd_prune_lab(lab_names):
+    """destroy the vms and networks of labs left in the docker container
+    (e.g. by a crashed job) and unregister them. Without names, only the
+    stale labs are removed.
+    """
+    assert_conf()
+    if not is_running_in_docker():
+        raise CommandError("Labs are only available in docker")
+
+    with file_lock(get_lab_lock()):
+        labs = get_labs()
+        for lab in lab_names:
+            if lab not in labs:
+                raise CommandError("lab '{}' not found".format(lab))
+        for lab in lab_names:
+            do_prune_lab(lab)
+        print("=> Running labs: {}".format(" ".join(get_running_labs())))
+
+
 @named("vm-list")
 def cmd_list_vm():
     """display vms in qdeploy.conf
@@ -456,6 +1092,8 @@ def cmd_start_vm(vm_names, start_all=False, group=None):
         vm_names = get_vm_group(group)
 
     vm_list = find_elem_list("vm", vm_names, start_all)
+    if get_lab_name() is not None:
+        check_lab_disks(vm_list)
     for vm in vm_list:
         do_start_vm(vm)
 
@@ -477,14 +1115,21 @@ def cmd_install_vm(vm_name, args):
 @arg("-a", "--all", dest="stop_all", help="stop all vms defined in qdeploy.conf")
 @arg("-s", "--shutdown")
 @arg("-r", "--reboot")
-def cmd_stop_vm(vm_names, stop_all=False, shutdown=False, reboot=False, group=None):
+@arg("--graceful", help="shutdown all vms at once, destroy the ones "
+     "still running after --timeout seconds")
+@arg("--timeout", type=int, help="deadline in seconds for --graceful")
+def cmd_stop_vm(vm_names, stop_all=False, shutdown=False, reboot=False,
+                graceful=False, timeout=QDEPLOY_SHUTDOWN_TIMEOUT, group=None):
     """stop and undefine one or several vms. By default the vm  is destroyed.
     """
     assert_conf()
-    if shutdown and reboot:
-        raise CommandError("Cannot have both '--shutdown' and '--reboot'")
+    if len([m for m in (shutdown, reboot, graceful) if m]) > 1:
+        raise CommandError("Cannot have more than one of '--shutdown', "
+                           "'--reboot' and '--graceful'")
 
-    if shutdown:
+    if graceful:
+        stop_mode = StopMode.GRACEFUL
+    elif shutdown:
         stop_mode = StopMode.SHUTDOWN
     elif reboot:
         stop_mode = StopMode.REBOOT
@@ -495,10 +1140,65 @@ def cmd_stop_vm(vm_names, stop_all=False, shutdown=False, reboot=False, group=No
         vm_names = get_vm_group(group)
 
     vm_list = find_elem_list("vm", vm_names, stop_all)
+    if stop_mode == StopMode.GRACEFUL:
+        do_stop_vm_list_graceful(vm_list, timeout)
+        return
+
     for vm in vm_list:
         do_stop_vm(vm, stop_mode)
 
 
+@named("vm-exec")
+@arg("cmd_to_execute", nargs=argparse.REMAINDER,
+     help="shell command to execute in the vms")
+@arg("-v", "--vm", dest="vm_names", action="append",
+     help="name of a vm (can be repeated)")
+@arg("-a", "--all", dest="exec_all", help="all vms defined in qdeploy.conf")
+@arg("-j", "--jobs", type=int, help="max number of vms handled concurrently")
+@arg("--timeout", type=int, help="deadline in seconds for each vm")
+def cmd_exec_vm(cmd_to_execute, vm_names=None, exec_all=False, group=None,
+                jobs=QDEPLOY_EXEC_JOBS, timeout=QDEPLOY_EXEC_TIMEOUT):
+    """execute a shell command in one or several vms through the
+    qemu-guest-agent
+    """
+    assert_conf()
+    if cmd_to_execute and cmd_to_execute[0] == "--":
+        cmd_to_execute = cmd_to_execute[1:]
+    if not cmd_to_execute:
+        raise CommandError("No command to execute")
+    if jobs < 1:
+        raise CommandError("'--jobs' must be at least 1")
+
+    if group is not None:
+        vm_names = get_vm_group(group)
+
+    vm_list = find_elem_list("vm", vm_names, exec_all)
+    command = " ".join(cmd_to_execute)
+
+    pool = ThreadPool(min(jobs, len(vm_list)) or 1)
+    try:
+        results = pool.map(lambda vm: do_exec_vm(vm, command, timeout),
+                           vm_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = []
+    for vm, res in zip(vm_list, results):
+        name = vm.find('name').text
+        print("=== {} (exit {}) ===".format(name, res.returncode))
+        if res.out:
+            print(res.out.rstrip())
+        if res.err:
+            print(res.err.rstrip(), file=sys.stderr)
+        if not res.success:
+            failed.append(name)
+
+    if failed:
+        print("Error: failed on {}".format(" ".join(failed)), file=sys.stderr)
+        sys.exit(1)
+
+
 @named("net-start")
 @arg("net_names", nargs='*')
 @arg("-a", "--all", dest="start_all")
@@ -510,6 +1210,8 @@ def cmd_start_nw(net_names, start_all=False):
     # :param start_all:  (Default value = False)
     assert_conf()
     nw_list = find_elem_list("network", net_names, start_all)
+    if get_lab_name() is not None:
+        check_lab_networks(nw_list)
     for nw in nw_list:
         do_start_nw(nw)
 
@@ -574,6 +1276,7 @@ def main():
     parser = argh.ArghParser()
     parser.add_commands([cmd_dumpconf, cmd_init, cmd_start_env, cmd_stop_env,
                          cmd_start_vm, cmd_install_vm, cmd_stop_vm, cmd_list_vm,
+                         cmd_exec_vm, cmd_list_lab, cmd_prune_lab,
                          cmd_start_nw, cmd_stop_nw, cmd_list_nw,
                          cmd_start_virtmgr, cmd_start_sh,
                          cmd_start, cmd_stop])
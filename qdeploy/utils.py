@@ -3,6 +3,8 @@ various utils functions
 """
 
 from __future__ import print_function
+from contextlib import contextmanager
+import fcntl
 import logging
 import os
 import shlex
@@ -124,6 +126,25 @@ def cmd(a_cmd, _shell=False, _detached=False, _env=None, _cwd=None,
 
 
 
+@contextmanager
+def file_lock(path):
+    """hold an exclusive lock on a file, e.g. to serialize several
+    virt-deploy processes on the same host
+
+    with file_lock("/tmp/foo.lock"):
+        do_something()
+
+    :param path: path of the lock file (created if needed)
+
+    """
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller
 
@@ -5,29 +5,78 @@ set -eu
 CONTAINER_NAME="$1"
 USE_X11="$2"
 MOUNTS="$3"
+PERSISTENT="${4:-false}"
 
 echo "container=$CONTAINER_NAME"
 echo "use_x11=$USE_X11"
 echo "mount=$MOUNTS"
+echo "persistent=$PERSISTENT"
 
 IMG_NAME=qdeploy_img
+FINGERPRINT_LABEL=qdeploy.fingerprint
 
 SYSMOUNTS="-v /sys/fs/cgroup:/sys/fs/cgroup:rw"
 
 docker build  -q -t $IMG_NAME .
 
+X11_OPTS=""
 if [[ "$USE_X11" == "true" ]]; then
     X11_SOCKET=/tmp/.X11-unix
     X11_OPTS="-e DISPLAY=$DISPLAY -v $X11_SOCKET:$X11_SOCKET"
+fi
+
+allow_x11() {
+    if [[ "$USE_X11" == "true" ]]; then
+        h=`docker inspect --format='{{ .Config.Hostname }}' $CONTAINER_NAME`
+        xhost +local:$h
+    fi
+}
+
+if [[ "$PERSISTENT" != "true" ]]; then
+    # a container left by the persistent mode (no --rm) would make
+    # docker run fail with 'name already in use'
+    if docker inspect $CONTAINER_NAME > /dev/null 2>&1; then
+        AUTO_REMOVE=`docker inspect \
+            --format='{{ .HostConfig.AutoRemove }}' $CONTAINER_NAME`
+        if [[ "$AUTO_REMOVE" != "true" ]]; then
+            echo "removing persistent container $CONTAINER_NAME"
+            docker rm -f $CONTAINER_NAME
+        fi
+    fi
     docker run --rm --name $CONTAINER_NAME -d \
            --privileged -e 'container=docker' \
-		   $X11_OPTS $SYSMOUNTS $MOUNTS $IMG_NAME
+           $X11_OPTS $SYSMOUNTS $MOUNTS $IMG_NAME
+    allow_x11
+    exit 0
+fi
+
+# persistent mode: the container is kept when stopped and restarted
+# as is, unless the mounts, the x11 setting or the image changed.
+IMG_ID=`docker image inspect --format='{{ .Id }}' $IMG_NAME`
+FINGERPRINT=`echo "$USE_X11|$MOUNTS|$IMG_ID" | sha1sum | cut -d' ' -f1`
+echo "fingerprint=$FINGERPRINT"
 
-	h=`docker inspect --format='{{ .Config.Hostname }}' $CONTAINER_NAME`
-    xhost +local:$h
+CURRENT=""
+if docker inspect $CONTAINER_NAME > /dev/null 2>&1; then
+    CURRENT=`docker inspect \
+        --format="{{ index .Config.Labels \"$FINGERPRINT_LABEL\" }}" \
+        $CONTAINER_NAME`
+    if [[ "$CURRENT" != "$FINGERPRINT" ]]; then
+        echo "configuration changed, recreating $CONTAINER_NAME"
+        docker rm -f $CONTAINER_NAME
+        CURRENT=""
+    fi
+fi
+
+if [[ -n "$CURRENT" ]]; then
+    RUNNING=`docker inspect --format='{{ .State.Running }}' $CONTAINER_NAME`
+    if [[ "$RUNNING" != "true" ]]; then
+        docker start $CONTAINER_NAME
+    fi
 else
-    docker run --rm --name $CONTAINER_NAME -d \
+    docker run --name $CONTAINER_NAME -d \
            --privileged -e 'container=docker' \
-           $SYSMOUNTS $MOUNTS $IMG_NAME
+           --label $FINGERPRINT_LABEL=$FINGERPRINT \
+           $X11_OPTS $SYSMOUNTS $MOUNTS $IMG_NAME
 fi
-
+allow_x11
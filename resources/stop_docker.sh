@@ -3,6 +3,11 @@
 set -eu
 
 CONTAINER_NAME=$1
-shift
+PERSISTENT="${2:-false}"
 
-docker kill $CONTAINER_NAME
+if [[ "$PERSISTENT" == "true" ]]; then
+    # keep the container (and its libvirt state) for the next start
+    docker stop $CONTAINER_NAME
+else
+    docker kill $CONTAINER_NAME
+fi